@@ -1,35 +1,68 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import List, Tuple, Dict, Optional
-import itertools
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import ijson
+import numpy as np
+import orjson
 import tqdm
 
 API_BASE = "https://escriptorium.inria.fr/api"
+MAX_WORKERS = 16
 
-def get_all_parts(document_id: int, token: str) -> List[int]:
-    """Fetch all part IDs for a document."""
-    headers = {"Authorization": f"Token {token}"}
+POOL_SIZE = 32
+
+def pooled_adapter(pool_size: int) -> HTTPAdapter:
+    """Builds an adapter keeping up to pool_size connections alive, retrying on 429 and 5xx."""
+    return HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    )
+
+SESSION = requests.Session()
+SESSION.mount("https://", pooled_adapter(POOL_SIZE))
+
+def get_all_parts(document_id: int) -> List[int]:
+    """Fetch all part IDs for a document, fetching the pages after the first concurrently."""
     url = f"{API_BASE}/documents/{document_id}/parts/"
-    part_ids = []
 
-    while url:
-        response = requests.get(url, headers=headers)
+    def fetch_page(page: int) -> List[int]:
+        response = SESSION.get(url, params={"page": page})
         response.raise_for_status()
-        data = response.json()
-        part_ids.extend(part["pk"] for part in data.get("results", []))
-        url = data.get("next")
+        return [part["pk"] for part in response.json().get("results", [])]
+
+    response = SESSION.get(url)
+    response.raise_for_status()
+    data = response.json()
+    part_ids = [part["pk"] for part in data.get("results", [])]
+    if not data.get("next") or not part_ids:
+        return part_ids
+
+    # The first page tells us how many pages there are, the others can be fetched at once
+    page_count = math.ceil(data["count"] / len(part_ids))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for page_part_ids in executor.map(fetch_page, range(2, page_count + 1)):
+            part_ids.extend(page_part_ids)
 
     return part_ids
 
-def get_lines_and_regions(document_id:int, part_id: int, token: str) -> Tuple[List[Dict], List[Dict]]:
-    """Fetch all lines for a part."""
-    headers = {"Authorization": f"Token {token}"}
+def get_lines_and_regions(document_id:int, part_id: int) -> Tuple[List[Dict], List[Dict]]:
+    """Fetch all lines for a part, parsing the payload while it is being downloaded."""
     url = f"{API_BASE}/documents/{document_id}/parts/{part_id}"
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    data = response.json()
-    lines = data.get("lines", [])
-    regions = data.get("regions", [])
+    lines, regions = [], []
+
+    with SESSION.get(url, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        for key, value in ijson.kvitems(response.raw, "", use_float=True):
+            if key == "lines":
+                lines = value
+            elif key == "regions":
+                regions = value
 
     return lines, regions
 
@@ -43,80 +76,104 @@ def extract_bbox(mask: List[List[Dict]]) -> Tuple[int, int, int, int]:
         ys = [pt[1] for pt in mask]
     return min(xs), min(ys), max(xs), max(ys)
 
-def rel_intersection(box_a: Tuple[int, int, int, int], box_b: Tuple[int, int, int, int]) -> float:
-    """Computes Intersection over Union (IoU) between two bounding boxes."""
-    x_a = max(box_a[0], box_b[0])
-    y_a = max(box_a[1], box_b[1])
-    x_b = min(box_a[2], box_b[2])
-    y_b = min(box_a[3], box_b[3])
-
-    width_a = abs(box_a[0]-box_a[2])
-    height_a = abs(box_a[1]-box_a[3])
-    if width_a == 0 or height_a == 0:
-        return 0
-
-    inter_width = max(0, x_b - x_a)
-    inter_height = max(0, y_b - y_a)
-    relative_intersection = inter_width * inter_height / (width_a*height_a)
-
-    return relative_intersection
-
+def extract_bboxes(masks: List[List[List]]) -> np.ndarray:
+    """Extracts the bounding boxes (x_min, y_min, x_max, y_max) of several mask polygons as an (N, 4) array."""
+    return np.array([extract_bbox(mask) for mask in masks], dtype=np.float64).reshape(-1, 4)
 
 def detect_reassignment(lines: List[Dict], regions: List[Dict]) -> List[Dict]:
-    region_bboxes = {region["pk"]: extract_bbox(region["box"]) for region in regions if region.get("box")}
-    require_updates: List[Dict] = []
-
-    for line in lines:
-        best_idx = -1
-        best_intersection = 0
-        for idx, zone in region_bboxes.items():
-            current_intersection = rel_intersection(extract_bbox(line["mask"]), zone)
-            if current_intersection > best_intersection and current_intersection > 0.0:
-                best_intersection = current_intersection
-                best_idx = idx
-        if best_idx != -1 and best_idx != line.get("region"):
-            line["region"] = best_idx
-            require_updates.append(line)
+    regions = [region for region in regions if region.get("box")]
+    if not lines or not regions:
+        return []
+
+    region_ids = np.fromiter((region["pk"] for region in regions), dtype=np.int64, count=len(regions))
+    line_bb = extract_bboxes([line["mask"] for line in lines])
+    region_bb = extract_bboxes([region["box"] for region in regions])
+
+    # Pairwise (L, R) intersection of every line with every region
+    ix1 = np.maximum(line_bb[:, None, 0], region_bb[None, :, 0])
+    iy1 = np.maximum(line_bb[:, None, 1], region_bb[None, :, 1])
+    ix2 = np.minimum(line_bb[:, None, 2], region_bb[None, :, 2])
+    iy2 = np.minimum(line_bb[:, None, 3], region_bb[None, :, 3])
+    iw = (ix2 - ix1).clip(min=0)
+    ih = (iy2 - iy1).clip(min=0)
+
+    # Flat lines have no area: their relative intersection is 0 and they never get reassigned
+    line_area = (line_bb[:, 2] - line_bb[:, 0]) * (line_bb[:, 3] - line_bb[:, 1])
+    rel = np.divide(iw * ih, line_area[:, None], out=np.zeros_like(iw), where=line_area[:, None] > 0)
+
+    # Only the best region matters: argmax is a single O(R) pass per line and keeps the first
+    # region on ties. Should a top-k ever be needed, use np.argpartition rather than a full argsort.
+    best_regions = region_ids[rel.argmax(axis=1)]
+    best_val = rel.max(axis=1)
+
+    # Only the lines whose best region changed are visited in Python
+    current_regions = np.fromiter((line.get("region") or -1 for line in lines), dtype=np.int64, count=len(lines))
+    changed = np.flatnonzero((best_val > 0) & (best_regions != current_regions))
+    # Masks dominate the size of a line, only the fields that change are sent back to the API
+    require_updates: List[Dict] = [
+        {"pk": lines[idx]["pk"], "region": region}
+        for idx, region in zip(changed.tolist(), best_regions[changed].tolist())
+    ]
 
     return require_updates
 
 
-def bulk_update(document_id: int, part_id: int, token: str, lines: List[Dict]):
+def bulk_update(document_id: int, part_id: int, lines: List[Dict]):
     url = f"{API_BASE}/documents/{document_id}/parts/{part_id}/lines/bulk_update/"
-    headers = {"Authorization": f"Token {token}"}
     payload = {"lines": lines}
-    response = requests.put(url, json=payload, headers=headers)
+    response = SESSION.put(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"})
     if not response.ok:
         print(f"✗ Failed to bulk update for part {part_id}: {response.status_code}")
     return response
 
 
-def recalculate_ordering(document_id: int, part_id: int, token: str) -> Optional[requests.Response]:
+def recalculate_ordering(document_id: int, part_id: int) -> Optional[requests.Response]:
     """Sends a GET request to recalculate ordering for a single part."""
     url = f"{API_BASE}/documents/{document_id}/parts/{part_id}/recalculate_ordering/"
-    headers = {"Authorization": f"Token {token}"}
-    response = requests.post(url, headers=headers)
+    response = SESSION.post(url)
     if not response.ok:
         print(f"✗ Failed to recalculate for part {part_id}: {response.status_code}")
     return response
 
+def reassign_part(document_id: int, part_id: int) -> int:
+    """Reassigns the lines of a single part, returns the number of lines that moved.
+
+    The ordering of the part is not recalculated here, see main.
+    """
+    lines, regions = get_lines_and_regions(document_id, part_id)
+    to_reassign = detect_reassignment(lines, regions)
+
+    if to_reassign:
+        bulk_update(document_id, part_id, to_reassign)
+    return len(to_reassign)
+
 def main(document_id: int, token: str):
+    SESSION.headers["Authorization"] = f"Token {token}"
     print(f"Checking document {document_id} for lines to reassign...")
-    part_ids = get_all_parts(document_id, token)
+    part_ids = get_all_parts(document_id)
 
-    with tqdm.tqdm(total=len(part_ids)) as bar:
+    parts_needing_recalc = []
+    with tqdm.tqdm(total=len(part_ids)) as bar, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         total_reassigned = 0
-        for part_id in part_ids:
-            lines, regions = get_lines_and_regions(document_id, part_id, token)
-            to_reassign = detect_reassignment(lines, regions)
-
-            if to_reassign:
-                total_reassigned += len(to_reassign)
-                bar.set_description(f"Reassigned: {total_reassigned} [+{len(to_reassign)} in {part_id}]")
-                bulk_update(document_id, part_id, token, to_reassign)
-                recalculate_ordering(document_id, part_id, token)
+        futures = {executor.submit(reassign_part, document_id, part_id): part_id for part_id in part_ids}
+        for future in as_completed(futures):
+            part_id = futures[future]
+            try:
+                reassigned = future.result()
+            except Exception as error:
+                # Keep going: the other parts may already be updated and still need their recalculation
+                print(f"✗ Failed to reassign lines of part {part_id}: {error}")
+                reassigned = 0
+
+            if reassigned:
+                total_reassigned += reassigned
+                parts_needing_recalc.append(part_id)
+                bar.set_description(f"Reassigned: {total_reassigned} [+{reassigned} in {part_id}]")
             bar.update(1)
 
+        # Recalculating the ordering is slow server-side, keep it out of the way of the fetches
+        list(executor.map(lambda part_id: recalculate_ordering(document_id, part_id), parts_needing_recalc))
+
 if __name__ == "__main__":
     import argparse
 
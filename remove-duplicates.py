@@ -1,34 +1,70 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import List, Tuple, Dict, Optional
-import itertools
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-API_BASE = "https://escriptorium.inria.fr/api"
+import ijson
+import numpy as np
+import orjson
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, every part then goes through the NumPy path
+    njit = None
 
-def get_all_parts(document_id: int, token: str) -> List[int]:
-    """Fetch all part IDs for a document."""
-    headers = {"Authorization": f"Token {token}"}
+API_BASE = "https://escriptorium.inria.fr/api"
+MAX_WORKERS = 16
+# Parts with more candidate pairs than this are deduplicated with the Numba kernel, when available:
+# the NumPy path holds every pair in memory, around 85 bytes each
+NUMBA_PAIR_THRESHOLD = 1_000_000
+
+POOL_SIZE = 32
+
+def pooled_adapter(pool_size: int) -> HTTPAdapter:
+    """Builds an adapter keeping up to pool_size connections alive, retrying on 429 and 5xx."""
+    return HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    )
+
+SESSION = requests.Session()
+SESSION.mount("https://", pooled_adapter(POOL_SIZE))
+
+def get_all_parts(document_id: int) -> List[int]:
+    """Fetch all part IDs for a document, fetching the pages after the first concurrently."""
     url = f"{API_BASE}/documents/{document_id}/parts/"
-    part_ids = []
 
-    while url:
-        response = requests.get(url, headers=headers)
+    def fetch_page(page: int) -> List[int]:
+        response = SESSION.get(url, params={"page": page})
         response.raise_for_status()
-        data = response.json()
-        part_ids.extend(part["pk"] for part in data.get("results", []))
-        url = data.get("next")
+        return [part["pk"] for part in response.json().get("results", [])]
+
+    response = SESSION.get(url)
+    response.raise_for_status()
+    data = response.json()
+    part_ids = [part["pk"] for part in data.get("results", [])]
+    if not data.get("next") or not part_ids:
+        return part_ids
+
+    # The first page tells us how many pages there are, the others can be fetched at once
+    page_count = math.ceil(data["count"] / len(part_ids))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for page_part_ids in executor.map(fetch_page, range(2, page_count + 1)):
+            part_ids.extend(page_part_ids)
 
     return part_ids
 
-def get_lines(document_id:int, part_id: int, token: str) -> List[Dict]:
-    """Fetch all lines for a part."""
-    headers = {"Authorization": f"Token {token}"}
+def get_lines(document_id:int, part_id: int) -> List[Dict]:
+    """Fetch all lines for a part, parsing the payload while it is being downloaded."""
     url = f"{API_BASE}/documents/{document_id}/parts/{part_id}"
-    lines = []
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    data = response.json()
-    lines.extend(data.get("lines", []))
+    with SESSION.get(url, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        lines = list(ijson.items(response.raw, "lines.item", use_float=True))
 
     return lines
 
@@ -42,82 +78,141 @@ def extract_bbox(mask: List[List[Dict]]) -> Tuple[int, int, int, int]:
         ys = [pt[1] for pt in mask]
     return min(xs), min(ys), max(xs), max(ys)
 
-def iou(boxA: Tuple[int, int, int, int], boxB: Tuple[int, int, int, int]) -> float:
-    """Computes Intersection over Union (IoU) between two bounding boxes."""
-    xA = max(boxA[0], boxB[0])
-    yA = max(boxA[1], boxB[1])
-    xB = min(boxA[2], boxB[2])
-    yB = min(boxA[3], boxB[3])
-
-    inter_width = max(0, xB - xA)
-    inter_height = max(0, yB - yA)
-    inter_area = inter_width * inter_height
-
-    if inter_area == 0:
-        return 0.0
-
-    areaA = (boxA[2] - boxA[0]) * (boxA[3] - boxA[1])
-    areaB = (boxB[2] - boxB[0]) * (boxB[3] - boxB[1])
-    union_area = areaA + areaB - inter_area
-
-    return inter_area / union_area
+def extract_bboxes(masks: List[List[List]]) -> np.ndarray:
+    """Extracts the bounding boxes (x_min, y_min, x_max, y_max) of several mask polygons as an (N, 4) array."""
+    return np.array([extract_bbox(mask) for mask in masks], dtype=np.float64).reshape(-1, 4)
+
+def sweep_y(bb: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorts the boxes by y_min and counts, for each of them, the following boxes that start above its y_max.
+
+    Lines are stacked vertically on a page, so each box only overlaps a few neighbours:
+    counts.sum() is the number of candidate pairs, known before any of them is built.
+    """
+    n = bb.shape[0]
+    order = np.argsort(bb[:, 1], kind="stable")
+    # In y_min order, box k overlaps the boxes that follow it until one starts below its y_max
+    ends = np.searchsorted(bb[order, 1], bb[order, 3], side="left")
+    counts = np.maximum(ends - np.arange(n) - 1, 0)
+    return order, counts
+
+
+def candidate_pairs(order: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Lists the pairs (i, j), i < j, of boxes whose vertical extents overlap, from the result of sweep_y."""
+    n = order.shape[0]
+    first = np.repeat(np.arange(n), counts)
+    second = first + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    first, second = order[first], order[second]
+    return np.minimum(first, second), np.maximum(first, second)
+
+
+if njit is not None:
+    # Not parallel=True: parts are already processed concurrently by the thread pool in main,
+    # and Numba's default workqueue threading layer aborts on concurrent parallel calls
+    @njit(cache=True)
+    def iou_duplicates(bb: np.ndarray, order: np.ndarray, counts: np.ndarray, thresh: float) -> np.ndarray:
+        """Flags the boxes to delete, in the same way as detect_duplicates_to_delete, walking the
+        candidate pairs of sweep_y one at a time instead of building them: memory stays linear
+        in the number of boxes whatever the number of pairs.
+        """
+        n = bb.shape[0]
+        delete = np.zeros(n, np.bool_)
+        for a in range(n):
+            for b in range(a + 1, a + 1 + counts[a]):
+                i, j = min(order[a], order[b]), max(order[a], order[b])
+                if bb[i, 2] <= bb[j, 0] or bb[j, 2] <= bb[i, 0] or bb[i, 3] <= bb[j, 1] or bb[j, 3] <= bb[i, 1]:
+                    continue
+                inter = (min(bb[i, 2], bb[j, 2]) - max(bb[i, 0], bb[j, 0])) * \
+                        (min(bb[i, 3], bb[j, 3]) - max(bb[i, 1], bb[j, 1]))
+                if inter == 0:
+                    continue
+                area_i = (bb[i, 2] - bb[i, 0]) * (bb[i, 3] - bb[i, 1])
+                area_j = (bb[j, 2] - bb[j, 0]) * (bb[j, 3] - bb[j, 1])
+                if inter / (area_i + area_j - inter) > thresh:
+                    # Delete the line with the smaller x_min
+                    delete[i if bb[i, 0] < bb[j, 0] else j] = True
+        return delete
 
 
 def detect_duplicates_to_delete(lines: List[Dict]) -> List[int]:
-    bboxes = {line["pk"]: extract_bbox(line["mask"]) for line in lines if line.get("mask")}
-    to_delete = set()
-    checked_pairs = set()
-
-    for (id1, box1), (id2, box2) in itertools.combinations(bboxes.items(), 2):
-        pair_key = tuple(sorted((id1, id2)))
-        if pair_key in checked_pairs:
-            continue
-        checked_pairs.add(pair_key)
-        score = iou(box1, box2)
-        if score > 0.5:
-            # Delete the line with the smaller x_min
-            delete_id = id1 if box1[0] < box2[0] else id2
-            to_delete.add(delete_id)
-
-    return list(to_delete)
-
-def bulk_delete_lines(document_id: int, part_id: int, line_ids: List[int], token: str):
+    masks = {line["pk"]: line["mask"] for line in lines if line.get("mask")}
+    if len(masks) < 2:
+        return []
+
+    pks = np.array(list(masks.keys()))
+    bb = extract_bboxes(list(masks.values()))
+
+    # Memory on the NumPy path grows with the number of candidate pairs, not of lines:
+    # a rotated page or a vertical script can yield millions of them from a few thousand lines
+    order, counts = sweep_y(bb)
+    if njit is not None and counts.sum() > NUMBA_PAIR_THRESHOLD:
+        return np.unique(pks[iou_duplicates(bb, order, counts, 0.5)]).tolist()
+
+    # Boxes that do not overlap on both axes cannot be duplicates: only score the overlapping pairs
+    i, j = candidate_pairs(order, counts)
+    overlap = (bb[i, 2] > bb[j, 0]) & (bb[i, 0] < bb[j, 2]) & (bb[i, 3] > bb[j, 1]) & (bb[i, 1] < bb[j, 3])
+    i, j = i[overlap], j[overlap]
+
+    wh = np.minimum(bb[i, 2:], bb[j, 2:]) - np.maximum(bb[i, :2], bb[j, :2])
+    inter = wh[:, 0] * wh[:, 1]
+    area = (bb[:, 2] - bb[:, 0]) * (bb[:, 3] - bb[:, 1])
+    # Flat boxes can touch without intersecting, leaving an empty union
+    scores = np.divide(inter, area[i] + area[j] - inter, out=np.zeros_like(inter), where=inter > 0)
+    duplicates = scores > 0.5
+    i, j = i[duplicates], j[duplicates]
+
+    # Delete the line with the smaller x_min
+    to_delete = np.where(bb[i, 0] < bb[j, 0], pks[i], pks[j])
+
+    return np.unique(to_delete).tolist()
+
+def bulk_delete_lines(document_id: int, part_id: int, line_ids: List[int]) -> requests.Response:
     url = f"{API_BASE}/documents/{document_id}/parts/{part_id}/lines/bulk_delete/"
-    headers = {
-        "Authorization": f"Token {token}",
-        "Content-Type": "application/json"
-    }
     payload = {"lines": line_ids}
-    response = requests.post(url, json=payload, headers=headers)
+    return SESSION.post(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"})
 
-    if response.ok:
-        print(f"✓ Deleted {len(line_ids)} lines in part {part_id}")
-    else:
-        print(f"✗ Failed to delete lines in part {part_id}: {response.status_code} - {response.text}")
-
-def recalculate_ordering(document_id: int, part_id: int, token: str) -> Optional[requests.Response]:
+def recalculate_ordering(document_id: int, part_id: int) -> Optional[requests.Response]:
     """Sends a GET request to recalculate ordering for a single part."""
     url = f"{API_BASE}/documents/{document_id}/parts/{part_id}/recalculate_ordering/"
-    headers = {"Authorization": f"Token {token}"}
-    response = requests.post(url, headers=headers)
+    response = SESSION.post(url)
     if not response.ok:
         print(f"✗ Failed to recalculate for part {part_id}: {response.status_code}")
     return response
 
+def remove_duplicates_in_part(document_id: int, part_id: int) -> int:
+    """Detects and deletes duplicate lines of a single part, returns the number of lines deleted.
+
+    Runs in a worker thread: the outcome is reported by main.
+    """
+    lines = get_lines(document_id, part_id)
+    to_delete = detect_duplicates_to_delete(lines)
+
+    if to_delete:
+        response = bulk_delete_lines(document_id, part_id, to_delete)
+        if not response.ok:
+            raise RuntimeError(f"{response.status_code} - {response.text}")
+        recalculate_ordering(document_id, part_id)
+    return len(to_delete)
+
 def main(document_id: int, token: str):
+    SESSION.headers["Authorization"] = f"Token {token}"
     print(f"Checking document {document_id} for duplicate lines...")
-    part_ids = get_all_parts(document_id, token)
-
-    for part_id in part_ids:
-        lines = get_lines(document_id, part_id, token)
-        to_delete = detect_duplicates_to_delete(lines)
-
-        if to_delete:
-            print(f"\nPart {part_id}: {len(to_delete)} lines to delete due to duplication.")
-            bulk_delete_lines(document_id, part_id, to_delete, token)
-            recalculate_ordering(document_id, part_id, token)
-        else:
-            print(f"Part {part_id} has no duplicates to delete.")
+    part_ids = get_all_parts(document_id)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(remove_duplicates_in_part, document_id, part_id): part_id for part_id in part_ids}
+        for future in as_completed(futures):
+            part_id = futures[future]
+            try:
+                deleted = future.result()
+            except Exception as error:
+                # Keep going: one failing part should not stop the others
+                print(f"✗ Failed to delete duplicate lines in part {part_id}: {error}")
+                continue
+
+            if deleted:
+                print(f"✓ Deleted {deleted} duplicate lines in part {part_id}")
+            else:
+                print(f"Part {part_id} has no duplicates to delete.")
 
 if __name__ == "__main__":
     import argparse
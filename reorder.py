@@ -1,42 +1,74 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import tqdm
 from typing import List, Optional
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 API_BASE = "https://escriptorium.inria.fr/api"
+MAX_WORKERS = 16
 
-def get_all_part_ids(document_id: int, token: str) -> List[int]:
-    """Fetches all part IDs for a given document, following pagination."""
-    headers = {"Authorization": f"Token {token}"}
+POOL_SIZE = 32
+
+def pooled_adapter(pool_size: int) -> HTTPAdapter:
+    """Builds an adapter keeping up to pool_size connections alive, retrying on 429 and 5xx."""
+    return HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    )
+
+SESSION = requests.Session()
+SESSION.mount("https://", pooled_adapter(POOL_SIZE))
+
+def get_all_part_ids(document_id: int) -> List[int]:
+    """Fetches all part IDs for a given document, fetching the pages after the first concurrently."""
     url = f"{API_BASE}/documents/{document_id}/parts/"
-    part_ids = []
 
-    while url:
-        response = requests.get(url, headers=headers)
+    def fetch_page(page: int) -> List[int]:
+        response = SESSION.get(url, params={"page": page})
         response.raise_for_status()
-        data = response.json()
+        return [part["pk"] for part in response.json().get("results", [])]
+
+    response = SESSION.get(url)
+    response.raise_for_status()
+    data = response.json()
+    part_ids = [part["pk"] for part in data.get("results", [])]
+    if not data.get("next") or not part_ids:
+        return part_ids
 
-        part_ids.extend(part["pk"] for part in data.get("results", []))
-        url = data.get("next")
+    # The first page tells us how many pages there are, the others can be fetched at once
+    page_count = math.ceil(data["count"] / len(part_ids))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for page_part_ids in executor.map(fetch_page, range(2, page_count + 1)):
+            part_ids.extend(page_part_ids)
 
     return part_ids
 
-def recalculate_ordering(document_id: int, part_id: int, token: str) -> Optional[requests.Response]:
+def recalculate_ordering(document_id: int, part_id: int) -> Optional[requests.Response]:
     """Sends a GET request to recalculate ordering for a single part."""
     url = f"{API_BASE}/documents/{document_id}/parts/{part_id}/recalculate_ordering/"
-    headers = {"Authorization": f"Token {token}"}
-    response = requests.post(url, headers=headers)
+    response = SESSION.post(url)
     if not response.ok:
         print(f"✗ Failed to recalculate for part {part_id}: {response.status_code}")
     return response
 
-def recalculate_all_parts(document_id: int, token: str):
+def recalculate_all_parts(document_id: int, token: str, workers: int = MAX_WORKERS):
     """Fetches all part IDs and sends recalculate ordering requests."""
+    SESSION.headers["Authorization"] = f"Token {token}"
+    # Each worker needs a pooled connection of its own, or the extra ones are discarded after every request
+    if workers > POOL_SIZE:
+        SESSION.mount("https://", pooled_adapter(workers))
     print(f"Fetching parts for document {document_id}...")
-    part_ids = get_all_part_ids(document_id, token)
+    part_ids = get_all_part_ids(document_id)
     print(f"Found {len(part_ids)} parts. Recalculating ordering...")
 
-    for part_id in tqdm.tqdm(part_ids):
-        recalculate_ordering(document_id, part_id, token)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(tqdm.tqdm(
+            executor.map(lambda part_id: recalculate_ordering(document_id, part_id), part_ids),
+            total=len(part_ids)
+        ))
 
 if __name__ == "__main__":
     import argparse
@@ -44,7 +76,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Recalculate ordering for all parts of a document.")
     parser.add_argument("document_id", type=int, help="Document ID on eScriptorium")
     parser.add_argument("token", type=str, help="Authorization token for eScriptorium API")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Number of concurrent recalculation requests")
 
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
 
-    recalculate_all_parts(args.document_id, args.token)
+    recalculate_all_parts(args.document_id, args.token, workers=args.workers)